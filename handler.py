@@ -1,30 +1,54 @@
 import os
-import shutil
 import time
+import socket
+import json
+import math
 import requests
+import urllib3
 import traceback
-import json
-import base64
+import orjson
+import pybase64
 import uuid
+import functools
 import logging
 import logging.handlers
+import queue
+import atexit
+import threading
+import types
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 import runpod
+import websocket
 import io
-from PIL import Image
+import numpy as np
+from PIL import Image, features
 from runpod.serverless.utils.rp_validator import validate
 from runpod.serverless.modules.rp_logger import RunPodLogger
-from requests.adapters import HTTPAdapter, Retry
+from urllib3.util import Retry
 from schemas.input import INPUT_SCHEMA
 
 
 APP_NAME = 'runpod-worker-comfyui'
 BASE_URI = 'http://127.0.0.1:3000'
+WS_URI = 'ws://127.0.0.1:3000/ws'
 VOLUME_MOUNT_PATH = '/runpod-volume'
 LOG_FILE = 'comfyui-worker.log'
 TIMEOUT = 600
 LOG_LEVEL = 'INFO'
+LOG_QUEUE_SIZE = 10000
 DISK_MIN_FREE_BYTES = 500 * 1024 * 1024  # 500MB in bytes
 JPEG_QUALITY = 95  # JPEG quality for output images (1-100, higher = better quality)
+JPEG_PASSTHROUGH_MIN_QUALITY = 90  # Minimum JPEG_QUALITY at which existing JPEGs are returned as is
+JPEG_SOI = b'\xff\xd8\xff'  # Magic bytes at the start of every JPEG file
+JPEG_OPTIMIZE = os.getenv('JPEG_OPTIMIZE', '').lower() in ('1', 'true', 'yes')  # Extra Huffman table pass for smaller but slower JPEGs
+
+# ComfyUI directories on the network volume
+_COMFY_OUTPUT = os.path.join(VOLUME_MOUNT_PATH, 'ComfyUI', 'output')
+_COMFY_TEMP = os.path.join(VOLUME_MOUNT_PATH, 'ComfyUI', 'temp')
+
+# Id of the job being processed by the current thread, used to tag log records
+_job_id_tls = threading.local()
 
 
 # ---------------------------------------------------------------------------- #
@@ -36,24 +60,29 @@ class SnapLogHandler(logging.Handler):
         self.app_name = app_name
         self.rp_logger = RunPodLogger()
         self.rp_logger.set_level(LOG_LEVEL)
-        self.runpod_endpoint_id = os.getenv('RUNPOD_ENDPOINT_ID')
-        self.runpod_cpu_count = os.getenv('RUNPOD_CPU_COUNT')
-        self.runpod_pod_id = os.getenv('RUNPOD_POD_ID')
-        self.runpod_gpu_size = os.getenv('RUNPOD_GPU_SIZE')
-        self.runpod_mem_gb = os.getenv('RUNPOD_MEM_GB')
-        self.runpod_gpu_count = os.getenv('RUNPOD_GPU_COUNT')
-        self.runpod_volume_id = os.getenv('RUNPOD_VOLUME_ID')
-        self.runpod_pod_hostname = os.getenv('RUNPOD_POD_HOSTNAME')
-        self.runpod_debug_level = os.getenv('RUNPOD_DEBUG_LEVEL')
-        self.runpod_dc_id = os.getenv('RUNPOD_DC_ID')
-        self.runpod_gpu_name = os.getenv('RUNPOD_GPU_NAME')
+        # Fields that are the same for every log record sent to the log API
+        self._static_payload = {
+            'app_name': self.app_name,
+            'runpod_endpoint_id': os.getenv('RUNPOD_ENDPOINT_ID'),
+            'runpod_cpu_count': os.getenv('RUNPOD_CPU_COUNT'),
+            'runpod_pod_id': os.getenv('RUNPOD_POD_ID'),
+            'runpod_gpu_size': os.getenv('RUNPOD_GPU_SIZE'),
+            'runpod_mem_gb': os.getenv('RUNPOD_MEM_GB'),
+            'runpod_gpu_count': os.getenv('RUNPOD_GPU_COUNT'),
+            'runpod_volume_id': os.getenv('RUNPOD_VOLUME_ID'),
+            'runpod_pod_hostname': os.getenv('RUNPOD_POD_HOSTNAME'),
+            'runpod_debug_level': os.getenv('RUNPOD_DEBUG_LEVEL'),
+            'runpod_dc_id': os.getenv('RUNPOD_DC_ID'),
+            'runpod_gpu_name': os.getenv('RUNPOD_GPU_NAME')
+        }
         self.log_api_endpoint = os.getenv('LOG_API_ENDPOINT')
         self.log_api_timeout = os.getenv('LOG_API_TIMEOUT', 5)
         self.log_api_timeout = int(self.log_api_timeout)
         self.log_token = os.getenv('LOG_API_TOKEN')
+        self.log_api_session = requests.Session()
 
     def emit(self, record):
-        runpod_job_id = os.getenv('RUNPOD_JOB_ID')
+        runpod_job_id = getattr(record, 'runpod_job_id', None)
 
         try:
             # Handle string formatting and extra arguments
@@ -93,30 +122,26 @@ class SnapLogHandler(logging.Handler):
 
             if self.log_api_endpoint:
                 try:
-                    headers = {'Authorization': f'Bearer {self.log_token}'}
+                    headers = {
+                        'Authorization': f'Bearer {self.log_token}',
+                        'Content-Type': 'application/json'
+                    }
+
+                    # Timestamp the record from its creation time in UTC rather than
+                    # going through the formatter's locale dependent formatTime
+                    log_asctime = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created))
 
                     log_payload = {
-                        'app_name': self.app_name,
-                        'log_asctime': self.formatter.formatTime(record),
+                        **self._static_payload,
+                        'log_asctime': f'{log_asctime}.{int(record.msecs):03d}Z',
                         'log_levelname': record.levelname,
                         'log_message': message,
-                        'runpod_endpoint_id': self.runpod_endpoint_id,
-                        'runpod_cpu_count': self.runpod_cpu_count,
-                        'runpod_pod_id': self.runpod_pod_id,
-                        'runpod_gpu_size': self.runpod_gpu_size,
-                        'runpod_mem_gb': self.runpod_mem_gb,
-                        'runpod_gpu_count': self.runpod_gpu_count,
-                        'runpod_volume_id': self.runpod_volume_id,
-                        'runpod_pod_hostname': self.runpod_pod_hostname,
-                        'runpod_debug_level': self.runpod_debug_level,
-                        'runpod_dc_id': self.runpod_dc_id,
-                        'runpod_gpu_name': self.runpod_gpu_name,
                         'runpod_job_id': runpod_job_id
                     }
 
-                    response = requests.post(
+                    response = self.log_api_session.post(
                         self.log_api_endpoint,
-                        json=log_payload,
+                        data=orjson.dumps(log_payload),
                         headers=headers,
                         timeout=self.log_api_timeout
                     )
@@ -134,81 +159,197 @@ class SnapLogHandler(logging.Handler):
             self.rp_logger.error(f'Error in log formatting: {str(e)}')
 
 
+class SnapQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands log records over to a background SnapLogHandler so that sending logs
+    to the log API never blocks the thread that is processing the job.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped_records = 0
+
+    def prepare(self, record):
+        # SnapLogHandler does its own message formatting, so only capture the
+        # job id here, while still on the thread that logged the record. A job
+        # id passed with extra={'job_id': ...} takes precedence.
+        record.runpod_job_id = getattr(record, 'job_id', None) or getattr(_job_id_tls, 'value', None)
+        return record
+
+    def enqueue(self, record):
+        # Drop the record rather than blocking if the log API can't keep up
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped_records += 1
+
+    def pop_dropped_records(self):
+        """
+        Return the number of records dropped since the last call, and reset it.
+        """
+        # enqueue runs with the handler lock held, so take it to read the count
+        self.acquire()
+        try:
+            dropped_records = self.dropped_records
+            self.dropped_records = 0
+        finally:
+            self.release()
+
+        return dropped_records
+
+
+def report_dropped_log_records(job_id=None):
+    """
+    Log a warning if any log records were dropped because the log queue was full.
+    """
+    for log_handler in logging.getLogger().handlers:
+        if isinstance(log_handler, SnapQueueHandler):
+            dropped_records = log_handler.pop_dropped_records()
+
+            if dropped_records:
+                logging.warning('Dropped %d log records because the log API could not keep up', dropped_records, extra={'job_id': job_id})
+
+
 # ---------------------------------------------------------------------------- #
 #                               ComfyUI Functions                              #
 # ---------------------------------------------------------------------------- #
+# Retry transient gateway errors immediately, there's no remote network to back off from
+retries = Retry(
+    total=3,
+    backoff_factor=0,
+    status_forcelist=[502, 503, 504],
+    allowed_methods=frozenset(['GET', 'POST'])
+)
+
+# A single keep-alive connection pool is shared by every request to the ComfyUI API so
+# that polling reuses one TCP connection instead of opening a new one per call. It's used
+# directly rather than through a requests session, which rebuilds a prepared request and
+# runs its cookie, redirect and proxy handling on every call to the local API.
+comfyui_pool = urllib3.connection_from_url(BASE_URI, maxsize=8, retries=retries, timeout=TIMEOUT)
+
+
 def wait_for_service(url):
+    # Only probe whether ComfyUI is accepting TCP connections, backing off
+    # exponentially from 10ms so that it is detected soon after it starts listening
+    parsed_url = urlsplit(url)
+    address = (parsed_url.hostname, parsed_url.port)
+    delay = 0.01
     retries = 0
 
     while True:
         try:
-            requests.get(url)
-            return
-        except requests.exceptions.RequestException:
+            with socket.create_connection(address, timeout=0.5):
+                return
+        except OSError:
             retries += 1
 
             # Only log every 15 retries so the logs don't get spammed
             if retries % 15 == 0:
                 logging.info('Service not ready yet. Retrying...')
         except Exception as err:
-            logging.error(f'Error: {err}')
+            logging.error('Error: %s', err)
 
-        time.sleep(0.2)
+        time.sleep(delay)
+        delay = min(delay * 2, 0.2)
 
 
 def send_get_request(endpoint):
-    return session.get(
-        url=f'{BASE_URI}/{endpoint}',
-        timeout=TIMEOUT
-    )
+    return comfyui_pool.request('GET', f'/{endpoint}')
 
 
 def send_post_request(endpoint, payload):
-    return session.post(
-        url=f'{BASE_URI}/{endpoint}',
-        json=payload,
-        timeout=TIMEOUT
+    return comfyui_pool.request(
+        'POST',
+        f'/{endpoint}',
+        body=orjson.dumps(payload),
+        headers={'Content-Type': 'application/json'}
     )
 
 
+def wait_for_prompt(ws, prompt_id):
+    """
+    Block until ComfyUI reports on the websocket that it has finished executing
+    the prompt, which it signals with an 'executing' message for node None.
+    Returns early if the websocket is lost, in which case the caller's history
+    polling detects when the prompt has finished instead.
+    """
+    while True:
+        try:
+            message = ws.recv()
+        except (websocket.WebSocketException, OSError) as e:
+            logging.warning('Lost the websocket connection to ComfyUI, polling the prompt history instead: %s', e)
+            return
+
+        # An empty message means that ComfyUI closed the connection
+        if not message:
+            logging.warning('ComfyUI closed the websocket connection, polling the prompt history instead')
+            return
+
+        # Binary messages are previews of the images being generated
+        if not isinstance(message, str):
+            continue
+
+        message = orjson.loads(message)
+
+        if message['type'] == 'executing':
+            data = message['data']
+
+            if data.get('node') is None and data.get('prompt_id') == prompt_id:
+                return
+
+
 def get_txt2img_payload(workflow, payload):
-    workflow["3"]["inputs"]["seed"] = payload["seed"]
-    workflow["3"]["inputs"]["steps"] = payload["steps"]
-    workflow["3"]["inputs"]["cfg"] = payload["cfg_scale"]
-    workflow["3"]["inputs"]["sampler_name"] = payload["sampler_name"]
+    sampler = workflow["3"]["inputs"]
+    sampler["seed"] = payload["seed"]
+    sampler["steps"] = payload["steps"]
+    sampler["cfg"] = payload["cfg_scale"]
+    sampler["sampler_name"] = payload["sampler_name"]
     workflow["4"]["inputs"]["ckpt_name"] = payload["ckpt_name"]
-    workflow["5"]["inputs"]["batch_size"] = payload["batch_size"]
-    workflow["5"]["inputs"]["width"] = payload["width"]
-    workflow["5"]["inputs"]["height"] = payload["height"]
+    latent = workflow["5"]["inputs"]
+    latent["batch_size"] = payload["batch_size"]
+    latent["width"] = payload["width"]
+    latent["height"] = payload["height"]
     workflow["6"]["inputs"]["text"] = payload["prompt"]
     workflow["7"]["inputs"]["text"] = payload["negative_prompt"]
     return workflow
 
 
 def get_img2img_payload(workflow, payload):
-    workflow["13"]["inputs"]["seed"] = payload["seed"]
-    workflow["13"]["inputs"]["steps"] = payload["steps"]
-    workflow["13"]["inputs"]["cfg"] = payload["cfg_scale"]
-    workflow["13"]["inputs"]["sampler_name"] = payload["sampler_name"]
-    workflow["13"]["inputs"]["scheduler"] = payload["scheduler"]
-    workflow["13"]["inputs"]["denoise"] = payload["denoise"]
+    width = payload["width"]
+    height = payload["height"]
+    sampler = workflow["13"]["inputs"]
+    sampler["seed"] = payload["seed"]
+    sampler["steps"] = payload["steps"]
+    sampler["cfg"] = payload["cfg_scale"]
+    sampler["sampler_name"] = payload["sampler_name"]
+    sampler["scheduler"] = payload["scheduler"]
+    sampler["denoise"] = payload["denoise"]
     workflow["1"]["inputs"]["ckpt_name"] = payload["ckpt_name"]
-    workflow["2"]["inputs"]["width"] = payload["width"]
-    workflow["2"]["inputs"]["height"] = payload["height"]
-    workflow["2"]["inputs"]["target_width"] = payload["width"]
-    workflow["2"]["inputs"]["target_height"] = payload["height"]
-    workflow["4"]["inputs"]["width"] = payload["width"]
-    workflow["4"]["inputs"]["height"] = payload["height"]
-    workflow["4"]["inputs"]["target_width"] = payload["width"]
-    workflow["4"]["inputs"]["target_height"] = payload["height"]
+
+    for node in ("2", "4"):
+        inputs = workflow[node]["inputs"]
+        inputs["width"] = width
+        inputs["height"] = height
+        inputs["target_width"] = width
+        inputs["target_height"] = height
+
     workflow["6"]["inputs"]["text"] = payload["prompt"]
     workflow["7"]["inputs"]["text"] = payload["negative_prompt"]
     return workflow
 
 
-def get_workflow_payload(workflow_name, payload):
+@functools.lru_cache(maxsize=16)
+def load_workflow_template(workflow_name):
+    """
+    Read a workflow template from disk. The templates don't change while the
+    worker is running, so each one is only read once.
+    """
     with open(f'/workflows/{workflow_name}.json', 'r') as json_file:
-        workflow = json.load(json_file)
+        return json_file.read()
+
+
+def get_workflow_payload(workflow_name, payload):
+    # Parse a fresh copy of the template every time since it gets modified
+    workflow = orjson.loads(load_workflow_template(workflow_name))
 
     if workflow_name == 'txt2img':
         workflow = get_txt2img_payload(workflow, payload)
@@ -216,41 +357,142 @@ def get_workflow_payload(workflow_name, payload):
     return workflow
 
 
-def convert_image_to_jpeg(image_path, quality=JPEG_QUALITY):
+# JPEG output buffer for each thread, reused for every image that the thread
+# converts so that it isn't reallocated and regrown from empty for every image
+_jpeg_buffer_tls = threading.local()
+
+
+def get_jpeg_buffer():
+    """
+    Return the calling thread's reusable JPEG buffer, rewound to the start.
+    The buffer isn't truncated, so only the data up to tell() is valid.
     """
-    Convert an image file to JPEG format and return base64 encoded data.
+    buffer = getattr(_jpeg_buffer_tls, 'buffer', None)
+
+    if buffer is None:
+        buffer = _jpeg_buffer_tls.buffer = io.BytesIO()
+
+    buffer.seek(0)
+    return buffer
+
+
+def convert_image_to_rgb(img):
+    """
+    Convert an image to RGB, flattening any transparency onto a white background
+    since JPEG doesn't support transparency.
+    """
+    if img.mode in ('RGBA', 'LA') and img.getchannel('A').getextrema() == (255, 255):
+        # Fully opaque, so there is nothing to flatten and the alpha band can just be dropped
+        return img.convert('RGB')
+    elif img.mode in ('RGBA', 'LA'):
+        # Blend onto white in a single vectorized pass (color * a + 255 * (1 - a)),
+        # using integer maths that fits in uint16 and rounds to nearest
+        arr = np.asarray(img)
+        alpha = arr[..., -1:].astype(np.uint16)
+        color = arr[..., :-1].astype(np.uint16)
+        rgb = ((color * alpha + 255 * (255 - alpha) + 127) // 255).astype(np.uint8)
+        if img.mode == 'LA':
+            # Spread the flattened grey band across the three RGB bands
+            rgb = rgb.repeat(3, axis=-1)
+        return Image.fromarray(rgb)
+    elif img.mode == 'PA' or 'transparency' in img.info:
+        # Composite any other image with transparency onto white in one step,
+        # rather than splitting out the alpha band to paste it with as a mask
+        background = Image.new('RGBA', img.size, (255, 255, 255, 255))
+        return Image.alpha_composite(background, img.convert('RGBA')).convert('RGB')
+    elif img.mode != 'RGB':
+        return img.convert('RGB')
+
+    return img
+
+
+def convert_image_to_jpeg(img, quality=JPEG_QUALITY):
+    """
+    Convert an image to JPEG format and return base64 encoded data.
     
     Args:
-        image_path (str): Path to the image file
+        img (PIL.Image.Image): The image to convert
         quality (int): JPEG quality (1-100, higher = better quality)
     
     Returns:
-        str: Base64 encoded JPEG image data
+        tuple: Base64 encoded JPEG image data, and the size of the JPEG in bytes
     """
     try:
-        # Open the image with PIL
-        with Image.open(image_path) as img:
-            # Convert RGBA to RGB if necessary (JPEG doesn't support transparency)
-            if img.mode in ('RGBA', 'LA'):
-                # Create a white background
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                if img.mode == 'RGBA':
-                    background.paste(img, mask=img.split()[-1])  # Use alpha channel as mask
-                else:
-                    background.paste(img)
-                img = background
-            elif img.mode != 'RGB':
-                img = img.convert('RGB')
-            
-            # Save as JPEG to a BytesIO buffer
-            buffer = io.BytesIO()
-            img.save(buffer, format='JPEG', quality=quality, optimize=True)
-            buffer.seek(0)
-            
-            # Encode to base64
-            return base64.b64encode(buffer.getvalue()).decode('utf-8')
+        img = convert_image_to_rgb(img)
+
+        buffer = get_jpeg_buffer()
+        # Baseline 4:2:0 JPEGs are libjpeg-turbo's fastest path
+        img.save(buffer, format='JPEG', quality=quality, subsampling=2, optimize=JPEG_OPTIMIZE, progressive=False)
+        jpeg_size = buffer.tell()
+
+        # Encode straight from the buffer's memory instead of from a getvalue() copy
+        with buffer.getbuffer() as view, view[:jpeg_size] as jpeg_bytes:
+            return pybase64.b64encode_as_string(jpeg_bytes), jpeg_size
     except Exception as e:
-        raise Exception(f"Failed to convert image {image_path} to JPEG: {str(e)}")
+        raise Exception(f"Failed to convert image to JPEG: {str(e)}")
+
+
+def convert_image_bytes_to_jpeg(image_bytes, quality=JPEG_QUALITY):
+    """
+    Convert the contents of an image file to JPEG format and return base64 encoded data.
+    Images that are already JPEGs are returned as they are rather than being decoded
+    and re-encoded, unless the quality is low enough that re-encoding would shrink them.
+
+    Args:
+        image_bytes (bytes): Contents of the image file
+        quality (int): JPEG quality (1-100, higher = better quality)
+
+    Returns:
+        tuple: Base64 encoded JPEG image data, and the size of the JPEG in bytes
+    """
+    if image_bytes.startswith(JPEG_SOI) and quality >= JPEG_PASSTHROUGH_MIN_QUALITY:
+        return pybase64.b64encode_as_string(image_bytes), len(image_bytes)
+
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        return convert_image_to_jpeg(img, quality)
+
+
+# Files are deleted in the background, so slow unlinks on network volumes don't delay the response
+_DELETE_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix='delete')
+
+
+def _safe_unlink(path, job_id=None):
+    """
+    Delete a file, logging instead of raising if it can't be deleted.
+    """
+    _job_id_tls.value = job_id
+
+    try:
+        os.remove(path)
+    except Exception as e:
+        logging.error('Error deleting file %s: %s', path, e, extra={'job_id': job_id})
+
+
+def process_output_image(image_path, job_id=None):
+    """
+    Convert an output image to a base64 encoded JPEG, and delete the image file.
+    Returns the base64 encoded JPEG data, or None if the image couldn't be converted.
+    """
+    # Tag the log records of the image thread with the job id
+    _job_id_tls.value = job_id
+    image_data = None
+
+    # Read the image once, for both its size and the conversion
+    with open(image_path, 'rb') as image_file:
+        image_bytes = image_file.read()
+
+    # Convert image to JPEG and base64 encode, logging a single record with the
+    # image size before and after conversion
+    try:
+        image_data, jpeg_size_bytes = convert_image_bytes_to_jpeg(image_bytes)
+        logging.info('Converted output image to JPEG: %s (%d bytes -> %d bytes)', image_path, len(image_bytes), jpeg_size_bytes, extra={'job_id': job_id})
+    except Exception as e:
+        logging.error('Error converting image %s (%d bytes) to JPEG: %s', image_path, len(image_bytes), e, extra={'job_id': job_id})
+
+    logging.debug('Deleting output file: %s', image_path, extra={'job_id': job_id})
+    _DELETE_POOL.submit(_safe_unlink, image_path, job_id)
+
+    return image_data
 
 
 def get_output_files(output):
@@ -275,36 +517,147 @@ def get_output_files(output):
 
 
 
+# Node types that save their output to disk, and need a unique filename
+_IMAGE_OUTPUT_NODES = frozenset({'SaveImage'})
+_TEXT_OUTPUT_NODES = frozenset({'SaveText|pysssss', 'SaveText', 'TextFileOutput', 'WriteTextFile'})
+
+
 def create_unique_filename_prefix(payload):
     """
     Create a unique filename prefix for each request to avoid a race condition where
     more than one request completes at the same time, which can either result in the
     incorrect output being returned, or the output file not being found.
     """
-    for key, value in payload.items():
+    for value in payload.values():
         class_type = value.get('class_type')
 
         # Handle image output nodes
-        if class_type == 'SaveImage':
-            payload[key]['inputs']['filename_prefix'] = str(uuid.uuid4())
-        
+        if class_type in _IMAGE_OUTPUT_NODES:
+            value['inputs']['filename_prefix'] = uuid.uuid4().hex
+
         # Handle text output nodes (common ComfyUI text output node types)
-        elif class_type in ['SaveText|pysssss', 'SaveText', 'TextFileOutput', 'WriteTextFile']:
-            if 'filename_prefix' in payload[key]['inputs']:
-                payload[key]['inputs']['filename_prefix'] = str(uuid.uuid4())
-            elif 'file' in payload[key]['inputs']:
+        elif class_type in _TEXT_OUTPUT_NODES:
+            inputs = value['inputs']
+
+            if 'filename_prefix' in inputs:
+                inputs['filename_prefix'] = uuid.uuid4().hex
+            elif 'file' in inputs:
                 # For SaveText|pysssss node, the filename field is called 'file'
-                original_filename = payload[key]['inputs']['file']
-                payload[key]['inputs']['file'] = f"{str(uuid.uuid4())}_{original_filename}"
-            elif 'filename' in payload[key]['inputs']:
+                inputs['file'] = f"{uuid.uuid4().hex}_{inputs['file']}"
+            elif 'filename' in inputs:
                 # If there's a filename field, prepend the UUID
-                original_filename = payload[key]['inputs']['filename']
-                payload[key]['inputs']['filename'] = f"{str(uuid.uuid4())}_{original_filename}"
+                inputs['filename'] = f"{uuid.uuid4().hex}_{inputs['filename']}"
 
 
 # ---------------------------------------------------------------------------- #
 #                              Telemetry functions                             #
 # ---------------------------------------------------------------------------- #
+def _first_existing_path(*paths):
+    """
+    Return the first of the given paths that exists, or None if none of them do.
+    """
+    for path in paths:
+        if os.path.exists(path):
+            return path
+
+    return None
+
+
+def _read_cgroup_file(path):
+    with open(path, 'r') as f:
+        return f.read().strip()
+
+
+# The cgroup layout (v2, v1, or the alternative v1 location) can't change while
+# the worker is running, so work out which files exist once at startup instead
+# of falling through a cascade of FileNotFoundErrors on every job
+_CGROUP_PATHS = {
+    'memory_limit': _first_existing_path(
+        '/sys/fs/cgroup/memory.max',
+        '/sys/fs/cgroup/memory/memory.limit_in_bytes',
+        '/sys/fs/cgroup/memory.limit_in_bytes'
+    ),
+    'memory_usage': _first_existing_path(
+        '/sys/fs/cgroup/memory.current',
+        '/sys/fs/cgroup/memory/memory.usage_in_bytes',
+        '/sys/fs/cgroup/memory.usage_in_bytes'
+    ),
+    'cpu_max': _first_existing_path(
+        '/sys/fs/cgroup/cpu.max'
+    ),
+    'cpu_quota': _first_existing_path(
+        '/sys/fs/cgroup/cpu/cpu.cfs_quota_us',
+        '/sys/fs/cgroup/cpu.cfs_quota_us'
+    ),
+    'cpu_period': _first_existing_path(
+        '/sys/fs/cgroup/cpu/cpu.cfs_period_us',
+        '/sys/fs/cgroup/cpu.cfs_period_us'
+    ),
+    'cpu_stat': _first_existing_path(
+        '/sys/fs/cgroup/cpu.stat'
+    ),
+    'cpuacct_usage': _first_existing_path(
+        '/sys/fs/cgroup/cpu/cpuacct.usage',
+        '/sys/fs/cgroup/cpuacct.usage'
+    ),
+    'io_stat': _first_existing_path(
+        '/sys/fs/cgroup/io.stat'
+    ),
+    'blkio_service_bytes': _first_existing_path(
+        '/sys/fs/cgroup/blkio/blkio.throttle.io_service_bytes',
+        '/sys/fs/cgroup/blkio.throttle.io_service_bytes'
+    )
+}
+
+# Whether to gather disk I/O stats from cgroups, nothing depends on them
+_LOG_IO_STATS = os.getenv('LOG_IO_STATS', '').lower() in ('1', 'true', 'yes')
+
+# Number of CPUs visible to the container
+_AVAILABLE_CPUS = os.sysconf('SC_NPROCESSORS_ONLN')
+
+# Threads used to gather the memory, CPU and disk telemetry at the same time
+_TELEMETRY_POOL = ThreadPoolExecutor(max_workers=3, thread_name_prefix='telemetry')
+
+
+def _read_cgroup_cpu_quota():
+    """
+    Read the CPU quota and period of the container from cgroups (v2 or v1).
+    Returns a (quota, period) tuple in microseconds, or None if the CPU quota
+    files don't exist or there is no quota.
+    """
+    if _CGROUP_PATHS['cpu_max']:
+        cpu_quota, cpu_period = _read_cgroup_file(_CGROUP_PATHS['cpu_max']).split()
+        if cpu_quota == 'max':
+            return None
+    elif _CGROUP_PATHS['cpu_quota'] and _CGROUP_PATHS['cpu_period']:
+        cpu_quota = _read_cgroup_file(_CGROUP_PATHS['cpu_quota'])
+        cpu_period = _read_cgroup_file(_CGROUP_PATHS['cpu_period'])
+    else:
+        return None
+
+    cpu_quota = int(cpu_quota)
+    cpu_period = int(cpu_period)
+
+    if cpu_quota <= 0 or cpu_period <= 0:  # -1 means no limit
+        return None
+
+    return cpu_quota, cpu_period
+
+
+# Threads used to convert the output images of a job concurrently. Pillow releases
+# the GIL while decoding and encoding images, so the conversions run in parallel.
+# RunPod limits containers with a CPU quota rather than a cpuset, so the pool is
+# capped at the quota as well as at the CPUs the worker may be scheduled on.
+_IMAGE_POOL_SIZE = len(os.sched_getaffinity(0))
+try:
+    _CPU_QUOTA = _read_cgroup_cpu_quota()
+except (OSError, ValueError):
+    _CPU_QUOTA = None
+if _CPU_QUOTA is not None:
+    _IMAGE_POOL_SIZE = min(_IMAGE_POOL_SIZE, math.ceil(_CPU_QUOTA[0] / _CPU_QUOTA[1]))
+_IMAGE_POOL = ThreadPoolExecutor(max_workers=_IMAGE_POOL_SIZE, thread_name_prefix='image')
+
+
 def get_container_memory_info(job_id=None):
     """
     Get memory information that's actually allocated to the container using cgroups.
@@ -331,69 +684,54 @@ def get_container_memory_info(job_id=None):
             if 'total' in mem_info and 'free' in mem_info:
                 mem_info['used'] = mem_info['total'] - mem_info['free']
         except Exception as e:
-            logging.warning(f"Failed to read host memory info: {str(e)}", job_id)
-
-        # Try cgroups v2 path first (modern Docker)
-        try:
-            with open('/sys/fs/cgroup/memory.max', 'r') as f:
-                max_mem = f.read().strip()
-                if max_mem != 'max':  # If set to 'max', it means unlimited
-                    mem_info['limit'] = int(max_mem) / (1024 * 1024 * 1024)  # Convert B to GB
-
-            with open('/sys/fs/cgroup/memory.current', 'r') as f:
-                mem_info['used'] = int(f.read().strip()) / (1024 * 1024 * 1024)  # Convert B to GB
+            logging.warning('Failed to read host memory info: %s', e, extra={'job_id': job_id})
 
-        except FileNotFoundError:
-            # Fall back to cgroups v1 paths (older Docker)
-            try:
-                with open('/sys/fs/cgroup/memory/memory.limit_in_bytes', 'r') as f:
-                    mem_limit = int(f.read().strip())
-                    # If the value is very large (close to 2^64), it's effectively unlimited
-                    if mem_limit < 2**63:
-                        mem_info['limit'] = mem_limit / (1024 * 1024 * 1024)  # Convert B to GB
-
-                with open('/sys/fs/cgroup/memory/memory.usage_in_bytes', 'r') as f:
-                    mem_info['used'] = int(f.read().strip()) / (1024 * 1024 * 1024)  # Convert B to GB
+        # Get the container memory limit and usage from cgroups
+        memory_limit_path = _CGROUP_PATHS['memory_limit']
+        memory_usage_path = _CGROUP_PATHS['memory_usage']
 
-            except FileNotFoundError:
-                # Try the third possible location for cgroups
-                try:
-                    with open('/sys/fs/cgroup/memory.limit_in_bytes', 'r') as f:
-                        mem_limit = int(f.read().strip())
-                        if mem_limit < 2**63:
-                            mem_info['limit'] = mem_limit / (1024 * 1024 * 1024)  # Convert B to GB
+        if memory_limit_path and memory_usage_path:
+            mem_limit = _read_cgroup_file(memory_limit_path)
 
-                    with open('/sys/fs/cgroup/memory.usage_in_bytes', 'r') as f:
-                        mem_info['used'] = int(f.read().strip()) / (1024 * 1024 * 1024)  # Convert B to GB
+            # A limit of 'max' (cgroups v2) or close to 2^64 (cgroups v1) means unlimited
+            if mem_limit != 'max' and int(mem_limit) < 2**63:
+                mem_info['limit'] = int(mem_limit) / (1024 * 1024 * 1024)  # Convert B to GB
 
-                except FileNotFoundError:
-                    logging.warning('Could not find cgroup memory information', job_id)
+            mem_info['used'] = int(_read_cgroup_file(memory_usage_path)) / (1024 * 1024 * 1024)  # Convert B to GB
+        else:
+            logging.warning('Could not find cgroup memory information', extra={'job_id': job_id})
 
         # Calculate available memory if we have both limit and used
         if 'limit' in mem_info and 'used' in mem_info:
             mem_info['available'] = mem_info['limit'] - mem_info['used']
 
-        # Log memory information
+        # Log memory information, leaving the formatting to logging
         mem_log_parts = []
+        mem_log_args = []
         if 'total' in mem_info:
-            mem_log_parts.append(f"Total={mem_info['total']:.2f}")
+            mem_log_parts.append('Total=%.2f')
+            mem_log_args.append(mem_info['total'])
         if 'limit' in mem_info:
-            mem_log_parts.append(f"Limit={mem_info['limit']:.2f}")
+            mem_log_parts.append('Limit=%.2f')
+            mem_log_args.append(mem_info['limit'])
         if 'used' in mem_info:
-            mem_log_parts.append(f"Used={mem_info['used']:.2f}")
+            mem_log_parts.append('Used=%.2f')
+            mem_log_args.append(mem_info['used'])
         if 'available' in mem_info:
-            mem_log_parts.append(f"Available={mem_info['available']:.2f}")
+            mem_log_parts.append('Available=%.2f')
+            mem_log_args.append(mem_info['available'])
         if 'free' in mem_info:
-            mem_log_parts.append(f"Free={mem_info['free']:.2f}")
+            mem_log_parts.append('Free=%.2f')
+            mem_log_args.append(mem_info['free'])
 
         if mem_log_parts:
-            logging.info(f"Container Memory (GB): {', '.join(mem_log_parts)}", job_id)
+            logging.info('Container Memory (GB): ' + ', '.join(mem_log_parts), *mem_log_args, extra={'job_id': job_id})
         else:
-            logging.info('Container memory information not available', job_id)
+            logging.info('Container memory information not available', extra={'job_id': job_id})
 
         return mem_info
     except Exception as e:
-        logging.error(f'Error getting container memory info: {str(e)}', job_id)
+        logging.error('Error getting container memory info: %s', e, extra={'job_id': job_id})
         return {}
 
 
@@ -406,86 +744,49 @@ def get_container_cpu_info(job_id=None):
     try:
         cpu_info = {}
 
-        # First get the number of CPUs visible to the container
-        try:
-            # Count available CPUs by checking /proc/cpuinfo
-            available_cpus = 0
-            with open('/proc/cpuinfo', 'r') as f:
-                for line in f:
-                    if line.startswith('processor'):
-                        available_cpus += 1
-            if available_cpus > 0:
-                cpu_info['available_cpus'] = available_cpus
-        except Exception as e:
-            logging.warning(f'Failed to get available CPUs: {str(e)}', job_id)
+        if _AVAILABLE_CPUS > 0:
+            cpu_info['available_cpus'] = _AVAILABLE_CPUS
 
-        # Try getting CPU quota and period from cgroups v2
-        try:
-            with open('/sys/fs/cgroup/cpu.max', 'r') as f:
-                cpu_data = f.read().strip().split()
-                if cpu_data[0] != 'max':
-                    cpu_quota = int(cpu_data[0])
-                    cpu_period = int(cpu_data[1])
-                    # Calculate the number of CPUs as quota/period
-                    cpu_info['allocated_cpus'] = cpu_quota / cpu_period
-        except FileNotFoundError:
-            # Try cgroups v1 paths
-            try:
-                with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', 'r') as f:
-                    cpu_quota = int(f.read().strip())
-                with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us', 'r') as f:
-                    cpu_period = int(f.read().strip())
-                if cpu_quota > 0:  # -1 means no limit
-                    cpu_info['allocated_cpus'] = cpu_quota / cpu_period
-            except FileNotFoundError:
-                # Try another possible location
-                try:
-                    with open('/sys/fs/cgroup/cpu.cfs_quota_us', 'r') as f:
-                        cpu_quota = int(f.read().strip())
-                    with open('/sys/fs/cgroup/cpu.cfs_period_us', 'r') as f:
-                        cpu_period = int(f.read().strip())
-                    if cpu_quota > 0:
-                        cpu_info['allocated_cpus'] = cpu_quota / cpu_period
-                except FileNotFoundError:
-                    logging.warning('Could not find cgroup CPU quota information', job_id)
+        # Get CPU quota and period from cgroups
+        if _CGROUP_PATHS['cpu_max'] or (_CGROUP_PATHS['cpu_quota'] and _CGROUP_PATHS['cpu_period']):
+            cpu_quota = _read_cgroup_cpu_quota()
+            if cpu_quota is not None:
+                # Calculate the number of CPUs as quota/period
+                cpu_info['allocated_cpus'] = cpu_quota[0] / cpu_quota[1]
+        else:
+            logging.warning('Could not find cgroup CPU quota information', extra={'job_id': job_id})
 
         # Get container CPU usage stats
-        try:
-            # Try cgroups v2 path
-            with open('/sys/fs/cgroup/cpu.stat', 'r') as f:
+        if _CGROUP_PATHS['cpu_stat']:
+            with open(_CGROUP_PATHS['cpu_stat'], 'r') as f:
                 for line in f:
                     if line.startswith('usage_usec'):
                         cpu_info['usage_usec'] = int(line.split()[1])
                         break
-        except FileNotFoundError:
-            # Try cgroups v1 path
-            try:
-                with open('/sys/fs/cgroup/cpu/cpuacct.usage', 'r') as f:
-                    cpu_info['usage_usec'] = int(f.read().strip()) / 1000  # Convert ns to μs
-            except FileNotFoundError:
-                try:
-                    with open('/sys/fs/cgroup/cpuacct.usage', 'r') as f:
-                        cpu_info['usage_usec'] = int(f.read().strip()) / 1000
-                except FileNotFoundError:
-                    pass
+        elif _CGROUP_PATHS['cpuacct_usage']:
+            cpu_info['usage_usec'] = int(_read_cgroup_file(_CGROUP_PATHS['cpuacct_usage'])) / 1000  # Convert ns to μs
 
-        # Log CPU information
+        # Log CPU information, leaving the formatting to logging
         cpu_log_parts = []
+        cpu_log_args = []
         if 'allocated_cpus' in cpu_info:
-            cpu_log_parts.append(f"Allocated CPUs={cpu_info['allocated_cpus']:.2f}")
+            cpu_log_parts.append('Allocated CPUs=%.2f')
+            cpu_log_args.append(cpu_info['allocated_cpus'])
         if 'available_cpus' in cpu_info:
-            cpu_log_parts.append(f"Available CPUs={cpu_info['available_cpus']}")
+            cpu_log_parts.append('Available CPUs=%d')
+            cpu_log_args.append(cpu_info['available_cpus'])
         if 'usage_usec' in cpu_info:
-            cpu_log_parts.append(f"Usage={cpu_info['usage_usec']/1000000:.2f}s")
+            cpu_log_parts.append('Usage=%.2fs')
+            cpu_log_args.append(cpu_info['usage_usec'] / 1000000)
 
         if cpu_log_parts:
-            logging.info(f"Container CPU: {', '.join(cpu_log_parts)}", job_id)
+            logging.info('Container CPU: ' + ', '.join(cpu_log_parts), *cpu_log_args, extra={'job_id': job_id})
         else:
-            logging.info('Container CPU allocation information not available', job_id)
+            logging.info('Container CPU allocation information not available', extra={'job_id': job_id})
 
         return cpu_info
     except Exception as e:
-        logging.error(f'Error getting container CPU info: {str(e)}', job_id)
+        logging.error('Error getting container CPU info: %s', e, extra={'job_id': job_id})
         return {}
 
 
@@ -498,109 +799,101 @@ def get_container_disk_info(job_id=None):
     try:
         disk_info = {}
 
-        # Get disk usage statistics for the root (/) mount
+        # Get disk usage and inode statistics for the root (/) mount from a single statvfs
         try:
-            total, used, free = shutil.disk_usage('/')
+            stat = os.statvfs('/')
+            total = stat.f_blocks * stat.f_frsize
+            used = (stat.f_blocks - stat.f_bfree) * stat.f_frsize
             disk_info['total_bytes'] = total
             disk_info['used_bytes'] = used
-            disk_info['free_bytes'] = free
+            disk_info['free_bytes'] = stat.f_bavail * stat.f_frsize
             disk_info['usage_percent'] = (used / total) * 100
+            disk_info['total_inodes'] = stat.f_files
+            disk_info['free_inodes'] = stat.f_ffree
+            disk_info['used_inodes'] = stat.f_files - stat.f_ffree
+            if stat.f_files > 0:
+                disk_info['inodes_usage_percent'] = ((stat.f_files - stat.f_ffree) / stat.f_files) * 100
         except Exception as e:
-            if job_id:
-                logging.warning(f'Failed to get disk usage stats: {str(e)}', job_id)
-            else:
-                logging.warning(f'Failed to get disk usage stats: {str(e)}', job_id)
+            logging.warning('Failed to get disk usage stats: %s', e, extra={'job_id': job_id})
 
-        # Try to get disk quota information from cgroups v2
-        try:
-            with open('/sys/fs/cgroup/io.stat', 'r') as f:
-                content = f.read().strip()
+        # Get disk I/O information from cgroups, which is only logged so is opt-in
+        if _LOG_IO_STATS:
+            if _CGROUP_PATHS['io_stat']:
+                content = _read_cgroup_file(_CGROUP_PATHS['io_stat'])
                 if content:
                     disk_info['io_stats_raw'] = content
-        except FileNotFoundError:
-            # Try cgroups v1
-            try:
-                with open('/sys/fs/cgroup/blkio/blkio.throttle.io_service_bytes', 'r') as f:
+            elif _CGROUP_PATHS['blkio_service_bytes']:
+                with open(_CGROUP_PATHS['blkio_service_bytes'], 'r') as f:
                     for line in f:
                         parts = line.strip().split()
                         if len(parts) >= 3 and 'Total' in line:
                             disk_info['io_bytes'] = int(parts[2])
                             break
-            except FileNotFoundError:
-                try:
-                    with open('/sys/fs/cgroup/blkio.throttle.io_service_bytes', 'r') as f:
-                        for line in f:
-                            parts = line.strip().split()
-                            if len(parts) >= 3 and 'Total' in line:
-                                disk_info['io_bytes'] = int(parts[2])
-                                break
-                except FileNotFoundError:
-                    if job_id:
-                        logging.warning('Could not find cgroup disk I/O information', job_id)
-                    else:
-                        logging.warning('Could not find cgroup disk I/O information', job_id)
-
-        # Get disk inodes information (important for container environments)
-        try:
-            import os
-            stat = os.statvfs('/')
-            disk_info['total_inodes'] = stat.f_files
-            disk_info['free_inodes'] = stat.f_ffree
-            disk_info['used_inodes'] = stat.f_files - stat.f_ffree
-            if stat.f_files > 0:
-                disk_info['inodes_usage_percent'] = ((stat.f_files - stat.f_ffree) / stat.f_files) * 100
-        except Exception as e:
-            if job_id:
-                logging.warning(f'Failed to get inode information: {str(e)}', job_id)
             else:
-                logging.warning(f'Failed to get inode information: {str(e)}', job_id)
+                logging.warning('Could not find cgroup disk I/O information', extra={'job_id': job_id})
 
-        # Log disk information
+        # Log disk information, leaving the formatting to logging
         disk_log_parts = []
+        disk_log_args = []
         if 'total_bytes' in disk_info:
-            disk_log_parts.append(f"Total={disk_info['total_bytes']/(1024**3):.2f}GB")
+            disk_log_parts.append('Total=%.2fGB')
+            disk_log_args.append(disk_info['total_bytes'] / (1024**3))
         if 'used_bytes' in disk_info:
-            disk_log_parts.append(f"Used={disk_info['used_bytes']/(1024**3):.2f}GB")
+            disk_log_parts.append('Used=%.2fGB')
+            disk_log_args.append(disk_info['used_bytes'] / (1024**3))
         if 'free_bytes' in disk_info:
-            disk_log_parts.append(f"Free={disk_info['free_bytes']/(1024**3):.2f}GB")
+            disk_log_parts.append('Free=%.2fGB')
+            disk_log_args.append(disk_info['free_bytes'] / (1024**3))
         if 'usage_percent' in disk_info:
-            disk_log_parts.append(f"Usage={disk_info['usage_percent']:.2f}%")
+            disk_log_parts.append('Usage=%.2f%%')
+            disk_log_args.append(disk_info['usage_percent'])
         if 'inodes_usage_percent' in disk_info:
-            disk_log_parts.append(f"Inodes={disk_info['inodes_usage_percent']:.2f}%")
+            disk_log_parts.append('Inodes=%.2f%%')
+            disk_log_args.append(disk_info['inodes_usage_percent'])
         if 'io_bytes' in disk_info:
-            disk_log_parts.append(f"I/O={disk_info['io_bytes']/(1024**2):.2f}MB")
+            disk_log_parts.append('I/O=%.2fMB')
+            disk_log_args.append(disk_info['io_bytes'] / (1024**2))
 
         if disk_log_parts:
-            if job_id:
-                logging.info(f"Container Disk: {', '.join(disk_log_parts)}", job_id)
-            else:
-                logging.info(f"Container Disk: {', '.join(disk_log_parts)}", job_id)
+            logging.info('Container Disk: ' + ', '.join(disk_log_parts), *disk_log_args, extra={'job_id': job_id})
         else:
-            if job_id:
-                logging.info('Container disk space information not available', job_id)
-            else:
-                logging.info('Container disk space information not available', job_id)
+            logging.info('Container disk space information not available', extra={'job_id': job_id})
 
         return disk_info
     except Exception as e:
-        if job_id:
-            logging.error(f'Error getting container disk info: {str(e)}', job_id)
-        else:
-            logging.error(f'Error getting container disk info: {str(e)}', job_id)
+        logging.error('Error getting container disk info: %s', e, extra={'job_id': job_id})
         return {}
 
 
+def get_container_info(job_id=None):
+    """
+    Get the memory, CPU and disk information of the container. The three are
+    gathered concurrently since each of them only waits on small file reads.
+    Returns a tuple of the memory, CPU and disk info dictionaries.
+    """
+    def run(telemetry_function):
+        # Tag the log records of the telemetry thread with the job id
+        _job_id_tls.value = job_id
+        return telemetry_function(job_id)
+
+    memory_future = _TELEMETRY_POOL.submit(run, get_container_memory_info)
+    cpu_future = _TELEMETRY_POOL.submit(run, get_container_cpu_info)
+    disk_future = _TELEMETRY_POOL.submit(run, get_container_disk_info)
+
+    return memory_future.result(), cpu_future.result(), disk_future.result()
+
+
 # ---------------------------------------------------------------------------- #
 #                                RunPod Handler                                #
 # ---------------------------------------------------------------------------- #
 def handler(event):
     job_id = event['id']
     os.environ['RUNPOD_JOB_ID'] = job_id
+    _job_id_tls.value = job_id
+    ws = None
 
     try:
-        memory_info = get_container_memory_info(job_id)
-        cpu_info = get_container_cpu_info(job_id)
-        disk_info = get_container_disk_info(job_id)
+        memory_info, cpu_info, disk_info = get_container_info(job_id)
 
         memory_available_gb = memory_info.get('available')
         disk_free_bytes = disk_info.get('free_bytes')
@@ -626,40 +919,51 @@ def handler(event):
         if workflow_name == 'default':
             workflow_name = 'txt2img'
 
-        logging.info(f'Workflow: {workflow_name}', job_id)
+        logging.info('Workflow: %s', workflow_name, extra={'job_id': job_id})
 
         if workflow_name != 'custom':
             try:
                 payload = get_workflow_payload(workflow_name, payload)
             except Exception as e:
-                logging.error(f'Unable to load workflow payload for: {workflow_name}', job_id)
+                logging.error('Unable to load workflow payload for: %s', workflow_name, extra={'job_id': job_id})
                 raise
 
         create_unique_filename_prefix(payload)
-        logging.debug('Queuing prompt', job_id)
+
+        # Connect to the websocket before queuing the prompt so that the
+        # message signalling that the prompt has finished can't be missed
+        client_id = uuid.uuid4().hex
+        ws = websocket.create_connection(f'{WS_URI}?clientId={client_id}', timeout=TIMEOUT)
+
+        # The timeout is only for connecting, ComfyUI sends nothing while a node runs
+        # and a single node can take longer than TIMEOUT
+        ws.settimeout(None)
+        logging.debug('Queuing prompt', extra={'job_id': job_id})
 
         queue_response = send_post_request(
             'prompt',
             {
-                'prompt': payload
+                'prompt': payload,
+                'client_id': client_id
             }
         )
 
-        if queue_response.status_code == 200:
-            resp_json = queue_response.json()
+        if queue_response.status == 200:
+            resp_json = orjson.loads(queue_response.data)
             prompt_id = resp_json['prompt_id']
-            logging.info(f'Prompt queued successfully: {prompt_id}', job_id)
+            logging.info('Prompt queued successfully: %s', prompt_id, extra={'job_id': job_id})
+            wait_for_prompt(ws, prompt_id)
             retries = 0
 
             while True:
                 # Only log every 15 retries so the logs don't get spammed
                 if retries == 0 or retries % 15 == 0:
-                    logging.info(f'Getting status of prompt: {prompt_id}', job_id)
+                    logging.info('Getting status of prompt: %s', prompt_id, extra={'job_id': job_id})
 
                 r = send_get_request(f'history/{prompt_id}')
-                resp_json = r.json()
+                resp_json = orjson.loads(r.data)
 
-                if r.status_code == 200 and len(resp_json):
+                if r.status == 200 and len(resp_json):
                     break
 
                 time.sleep(0.2)
@@ -671,62 +975,54 @@ def handler(event):
                 # Job was processed successfully
                 outputs = resp_json[prompt_id]['outputs']
 
-                logging.info(f'Files generated successfully for prompt: {prompt_id}', job_id)
+                logging.info('Files generated successfully for prompt: %s', prompt_id, extra={'job_id': job_id})
+                # Extract unique prefix from the payload for better file matching of text files
+                unique_prefix = None
+                for value in payload.values():
+                    inputs = value.get('inputs') if isinstance(value, dict) else None
+                    if inputs is None:
+                        continue
+
+                    if 'filename_prefix' in inputs:
+                        unique_prefix = inputs['filename_prefix']
+                        break
+
+                    # For SaveText|pysssss node the filename is in 'file', otherwise in 'filename'.
+                    # Either way, extract the UUID prefix from the filename.
+                    filename = inputs.get('file')
+                    if not isinstance(filename, str):
+                        filename = inputs.get('filename')
+                        if not isinstance(filename, str):
+                            continue
+
+                    prefix, separator, _ = filename.partition('_')
+                    if separator:
+                        unique_prefix = prefix
+                        break
+
                 output_files = get_output_files(outputs)
-                images = []
+                image_futures = []
                 text_files = []
 
-                # Process image files from ComfyUI output structure
+                # Process image files from ComfyUI output structure. The output images
+                # are converted concurrently, while the remaining files are handled.
                 for output_file in output_files:
                     if output_file['type'] == 'image':
                         filename = output_file['data'].get('filename')
                         file_type = output_file['data'].get('type')
 
                         if file_type == 'output':
-                            image_path = f'{VOLUME_MOUNT_PATH}/ComfyUI/output/{filename}'
+                            image_path = f'{_COMFY_OUTPUT}/{filename}'
 
                             if os.path.exists(image_path):
-                                # Log the image file size before conversion
-                                image_size_bytes = os.path.getsize(image_path)
-                                image_size_mb = image_size_bytes / (1024 * 1024)
-                                logging.info(f'Output image size: {image_size_bytes} bytes ({image_size_mb:.2f} MB) for {image_path}', job_id)
-                                # Convert image to JPEG and base64 encode
-                                # Save JPEG to a temp buffer to get its size
-                                try:
-                                    with Image.open(image_path) as img:
-                                        if img.mode in ('RGBA', 'LA'):
-                                            background = Image.new('RGB', img.size, (255, 255, 255))
-                                            if img.mode == 'RGBA':
-                                                background.paste(img, mask=img.split()[-1])
-                                            else:
-                                                background.paste(img)
-                                            img = background
-                                        elif img.mode != 'RGB':
-                                            img = img.convert('RGB')
-                                        buffer = io.BytesIO()
-                                        img.save(buffer, format='JPEG', quality=JPEG_QUALITY, optimize=True)
-                                        jpeg_bytes = buffer.getvalue()
-                                        jpeg_size_bytes = len(jpeg_bytes)
-                                        jpeg_size_mb = jpeg_size_bytes / (1024 * 1024)
-                                        logging.info(f'JPEG image size: {jpeg_size_bytes} bytes ({jpeg_size_mb:.2f} MB) for {image_path}', job_id)
-                                        image_data = base64.b64encode(jpeg_bytes).decode('utf-8')
-                                        images.append(image_data)
-                                except Exception as e:
-                                    logging.error(f'Error converting image to JPEG and logging size: {e}', job_id)
-                                logging.info(f'Converted and encoded image to JPEG: {image_path}', job_id)
-                                logging.info(f'Deleting output file: {image_path}', job_id)
-                                os.remove(image_path)
+                                image_futures.append(_IMAGE_POOL.submit(process_output_image, image_path, job_id))
                         elif file_type == 'temp':
-                            image_path = f'{VOLUME_MOUNT_PATH}/ComfyUI/temp/{filename}'
+                            image_path = f'{_COMFY_TEMP}/{filename}'
 
                             # Clean up temp images that aren't used by the API
                             if os.path.exists(image_path):
-                                logging.info(f'Deleting temp file: {image_path}', job_id)
-
-                                try:
-                                    os.remove(image_path)
-                                except Exception as e:
-                                    logging.error(f'Error deleting temp file {image_path}: {e}')
+                                logging.debug('Deleting temp file: %s', image_path, extra={'job_id': job_id})
+                                _DELETE_POOL.submit(_safe_unlink, image_path, job_id)
                             else:
                                 # Check if the image exists in the /tmp directory
                                 # NOTE: This is a specific workaround in a ComfyUI fork, and should
@@ -734,34 +1030,17 @@ def handler(event):
                                 image_path = f'/tmp/{filename}'
 
                                 if os.path.exists(image_path):
-                                    logging.info(f'Deleting temp file: {image_path}', job_id)
+                                    logging.debug('Deleting temp file: %s', image_path, extra={'job_id': job_id})
+                                    _DELETE_POOL.submit(_safe_unlink, image_path, job_id)
 
-                                    try:
-                                        os.remove(image_path)
-                                    except Exception as e:
-                                        logging.error(f'Error deleting temp file {image_path}: {e}')
+                # Collect the converted images in one pass, keeping them in their original order
+                images = []
+                for future in image_futures:
+                    image_data = future.result()
+                    if image_data is not None:
+                        images.append(image_data)
 
                 # Text files are saved directly to disk by SaveText nodes and need to be found via filesystem scanning
-                # Extract unique prefix from the payload for better file matching
-                unique_prefix = None
-                for key, value in payload.items():
-                    if isinstance(value, dict) and 'inputs' in value:
-                        if 'filename_prefix' in value['inputs']:
-                            unique_prefix = value['inputs']['filename_prefix']
-                            break
-                        elif 'file' in value['inputs'] and isinstance(value['inputs']['file'], str):
-                            # For SaveText|pysssss node, extract the UUID prefix from the filename
-                            filename = value['inputs']['file']
-                            if '_' in filename:
-                                unique_prefix = filename.split('_')[0]
-                                break
-                        elif 'filename' in value['inputs'] and isinstance(value['inputs']['filename'], str):
-                            # Extract UUID prefix from filename
-                            filename = value['inputs']['filename']
-                            if '_' in filename:
-                                unique_prefix = filename.split('_')[0]
-                                break
-                
                 text_files = scan_for_text_files(job_id, unique_prefix)
 
                 response = {
@@ -777,7 +1056,7 @@ def handler(event):
                 memory_available_gb = memory_info.get('available')
 
                 if memory_available_gb is not None and memory_available_gb < 1.0:
-                    logging.info(f'Low memory detected: {memory_available_gb:.2f} GB available, refreshing worker', job_id)
+                    logging.info('Low memory detected: %.2f GB available, refreshing worker', memory_available_gb, extra={'job_id': job_id})
                     response['refresh_worker'] = True
 
                 return response
@@ -796,30 +1075,41 @@ def handler(event):
                             # Log to file instead of RunPod because the output tends to be too verbose
                             # and gets dropped by RunPod logging
                             error_msg = f'Job did not process successfully for prompt_id: {prompt_id}'
-                            logging.error(error_msg, job_id)
-                            logging.info(f'{job_id}: Response JSON: {resp_json}', job_id)
+                            logging.error(error_msg, extra={'job_id': job_id})
+                            logging.info('%s: Response JSON: %s', job_id, resp_json, extra={'job_id': job_id})
                             raise RuntimeError(error_msg)
 
         else:
             try:
-                queue_response_content = queue_response.json()
+                queue_response_content = orjson.loads(queue_response.data)
             except Exception as e:
-                queue_response_content = str(queue_response.content)
+                queue_response_content = str(queue_response.data)
 
-            logging.error(f'HTTP Status code: {queue_response.status_code}', job_id)
-            logging.error(queue_response_content, job_id)
+            logging.error('HTTP Status code: %s', queue_response.status, extra={'job_id': job_id})
+            logging.error('%s', queue_response_content, extra={'job_id': job_id})
 
             return {
-                'error': f'HTTP status code: {queue_response.status_code}',
+                'error': f'HTTP status code: {queue_response.status}',
                 'output': queue_response_content
             }
     except Exception as e:
-        logging.error(f'An exception was raised: {e}', job_id)
+        logging.error('An exception was raised: %s', e, extra={'job_id': job_id})
 
         return {
             'error': traceback.format_exc(),
             'refresh_worker': True
         }
+    finally:
+        if ws is not None:
+            ws.close()
+
+        report_dropped_log_records(job_id)
+
+
+# Common text file extensions
+_TEXT_FILE_EXTENSIONS = frozenset({'.txt', '.json', '.xml', '.csv', '.log', '.md', '.yaml', '.yml'})
+# Directories that SaveText nodes may write to
+_SCAN_DIRS = (_COMFY_OUTPUT, _COMFY_TEMP, '/tmp')
 
 
 def scan_for_text_files(job_id, unique_prefix=None):
@@ -829,52 +1119,58 @@ def scan_for_text_files(job_id, unique_prefix=None):
     """
     text_files = []
     
-    # Common text file extensions
-    text_extensions = ['.txt', '.json', '.xml', '.csv', '.log', '.md', '.yaml', '.yml']
-    
-    # Directories to scan
-    scan_dirs = [
-        f'{VOLUME_MOUNT_PATH}/ComfyUI/output',
-        f'{VOLUME_MOUNT_PATH}/ComfyUI/temp',
-        '/tmp'
-    ]
-    
-    for scan_dir in scan_dirs:
+    for scan_dir in _SCAN_DIRS:
         try:
             if os.path.exists(scan_dir):
-                for filename in os.listdir(scan_dir):
-                    file_path = os.path.join(scan_dir, filename)
-                    
-                    # Check if it's a text file
-                    if any(filename.lower().endswith(ext) for ext in text_extensions):
-                        # If we have a unique prefix, only process files with that prefix
+                with os.scandir(scan_dir) as entries:
+                    for entry in entries:
+                        filename = entry.name
+
+                        # If we have a unique prefix, only process files with that prefix.
+                        # This is checked first, as it rejects most of the entries.
                         if unique_prefix and not filename.startswith(unique_prefix):
                             continue
-                            
+
+                        # Check if it's a text file, lowercasing only the extension
+                        extension_start = filename.rfind('.')
+                        if extension_start == -1 or filename[extension_start:].lower() not in _TEXT_FILE_EXTENSIONS:
+                            continue
+
+                        # Skip subdirectories and other non-regular entries
+                        if not entry.is_file(follow_symlinks=False):
+                            continue
+
+                        file_path = entry.path
+
                         try:
-                            with open(file_path, 'r', encoding='utf-8') as f:
-                                content = f.read()
-                                text_files.append({
-                                    'filename': filename,
-                                    'content': content
-                                })
-                                logging.info(f'Found and processed additional text file: {file_path}', job_id)
-                                os.remove(file_path)
-                        except Exception as e:
-                            # Try reading as binary with UTF-8 decoding
+                            # Read the whole file with unbuffered reads, sized to the file so
+                            # that usually one is enough. Reads can come up short on network
+                            # mounts, and the file may have grown, so read until end of file.
+                            # Undecodable bytes are replaced rather than failing.
+                            chunk_size = max(entry.stat(follow_symlinks=False).st_size, 4096)
+                            chunks = []
+                            fd = os.open(file_path, os.O_RDONLY)
                             try:
-                                with open(file_path, 'rb') as f:
-                                    content = f.read().decode('utf-8', errors='replace')
-                                    text_files.append({
-                                        'filename': filename,
-                                        'content': content
-                                    })
-                                    logging.info(f'Found and processed additional text file (binary mode): {file_path}', job_id)
-                                    os.remove(file_path)
-                            except Exception as e2:
-                                logging.error(f'Error processing additional text file {file_path}: {e2}', job_id)
+                                while True:
+                                    chunk = os.read(fd, chunk_size)
+                                    if not chunk:
+                                        break
+                                    chunks.append(chunk)
+                            finally:
+                                os.close(fd)
+                            content = b''.join(chunks).decode('utf-8', errors='replace')
+                            # Translate newlines like reading in text mode does
+                            content = content.replace('\r\n', '\n').replace('\r', '\n')
+                            text_files.append({
+                                'filename': filename,
+                                'content': content
+                            })
+                            logging.info('Found and processed additional text file: %s', file_path, extra={'job_id': job_id})
+                            _DELETE_POOL.submit(_safe_unlink, file_path, job_id)
+                        except Exception as e:
+                            logging.error('Error processing additional text file %s: %s', file_path, e, extra={'job_id': job_id})
         except Exception as e:
-            logging.warning(f'Error scanning directory {scan_dir}: {e}', job_id)
+            logging.warning('Error scanning directory %s: %s', scan_dir, e, extra={'job_id': job_id})
     
     return text_files
 
@@ -890,14 +1186,44 @@ def setup_logging():
     formatter = logging.Formatter('%(asctime)s : %(levelname)s : %(message)s')
     log_handler = SnapLogHandler(APP_NAME)
     log_handler.setFormatter(formatter)
-    root_logger.addHandler(log_handler)
+
+    # Records are emitted by a background listener thread so that slow log
+    # API requests don't hold up the RunPod job
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    root_logger.addHandler(SnapQueueHandler(log_queue))
+
+
+def setup_result_serialization():
+    """
+    Serialize job results with orjson rather than the json module when the RunPod SDK
+    sends them back, since the base64 encoded images make the results several MB.
+    """
+    try:
+        from runpod.serverless.modules import rp_http
+    except ImportError:
+        return
+
+    # Leave SDK versions that don't serialize with the json module alone
+    if getattr(rp_http, 'json', None) is not json:
+        return
+
+    def dumps(obj, **kwargs):
+        # orjson always writes UTF-8 without escaping, like json.dumps(ensure_ascii=False)
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    rp_http.json = types.SimpleNamespace(dumps=dumps)
 
 
 if __name__ == '__main__':
-    session = requests.Session()
-    retries = Retry(total=10, backoff_factor=0.1, status_forcelist=[502, 503, 504])
-    session.mount('http://', HTTPAdapter(max_retries=retries))
     setup_logging()
+    setup_result_serialization()
+
+    if not features.check_feature('libjpeg_turbo'):
+        logging.warning('Pillow is not built against libjpeg-turbo, JPEG encoding will be slower')
+
     wait_for_service(url=f'{BASE_URI}/system_stats')
     logging.info('ComfyUI API is ready')
     logging.info('Starting RunPod Serverless...')